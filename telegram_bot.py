@@ -6,8 +6,14 @@ Supports 3 widgets: Finance, Dating, Todos.
 
 import os
 import re
-import json
+import copy
+import time
+import functools
+import random
+import asyncio
 import base64
+import logging
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 from telegram import Update, Bot
@@ -19,6 +25,10 @@ from telegram.ext import (
     ContextTypes,
 )
 import httpx
+import orjson
+import fastjsonschema
+
+logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -33,11 +43,113 @@ LOCAL_TZ = ZoneInfo("Asia/Singapore")                # SGT UTC+8
 WIKI_TABLE = "wiki_pages"
 
 ALLOWED_USERS = {268934826, 7738099781}
+CLAUDE_RPM = int(os.environ.get("CLAUDE_RPM", "50"))  # stay under the account's rate limit
+# Safety-net poll for reminders; each poll also arms an exact wake-up for the
+# next reminder due before the following poll. Only reminders the sidecar
+# writes for sooner than that wait on the poll itself.
+REMINDER_POLL_INTERVAL = int(os.environ.get("REMINDER_POLL_INTERVAL", "60"))
+
+# Static request headers, built once rather than per call.
+ANTHROPIC_HEADERS = {
+    "x-api-key": ANTHROPIC_API_KEY,
+    "anthropic-version": "2023-06-01",
+    "content-type": "application/json",
+}
+SUPABASE_HEADERS = {
+    "apikey": DATABASE_KEY,
+    "Authorization": f"Bearer {DATABASE_KEY}",
+}
+SUPABASE_WRITE_HEADERS = {
+    **SUPABASE_HEADERS,
+    "Content-Type": "application/json",
+    "Prefer": "return=minimal",
+}
+
+
+class _RetryTransport(httpx.AsyncHTTPTransport):
+    """Retry transient failures (network errors, 408/429/5xx) of idempotent
+    requests with exponential backoff plus jitter, honouring Retry-After up to
+    BACKOFF_CAP (a longer wait returns the response rather than stall).
+
+    GET/HEAD/PUT/DELETE/OPTIONS are retried as-is; any other request opts in with
+    extensions={"idempotent": True}. Plain inserts are never replayed here.
+    """
+
+    RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+    ATTEMPTS = 5
+    BACKOFF_BASE = 0.5   # seconds
+    BACKOFF_CAP = 8.0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method not in self.IDEMPOTENT_METHODS and not request.extensions.get("idempotent"):
+            return await super().handle_async_request(request)
+
+        for attempt in range(self.ATTEMPTS):
+            last = attempt == self.ATTEMPTS - 1
+            delay = min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt) + random.random() * self.BACKOFF_BASE
+            try:
+                resp = await super().handle_async_request(request)
+            except httpx.TransportError as e:
+                if last:
+                    raise
+                logger.warning("%s %s failed (%s), retrying in %.1fs", request.method, request.url.path, e, delay)
+            else:
+                if resp.status_code not in self.RETRY_STATUSES or last:
+                    return resp
+                try:
+                    retry_after = float(resp.headers.get("retry-after", 0))
+                except ValueError:
+                    retry_after = 0.0
+                if retry_after > self.BACKOFF_CAP:
+                    return resp
+                delay = max(delay, retry_after)
+                await resp.aclose()
+                logger.warning("%s %s returned %s, retrying in %.1fs",
+                               request.method, request.url.path, resp.status_code, delay)
+            await asyncio.sleep(delay)
+
+
+# One keep-alive (HTTP/2) pool per upstream, shared by every handler so a
+# message doesn't pay a fresh TCP + TLS handshake. Closed in _post_shutdown.
+_anthropic = httpx.AsyncClient(
+    base_url="https://api.anthropic.com/v1",
+    headers=ANTHROPIC_HEADERS,
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+)
+# A custom transport owns the pool, so http2/limits are set on it.
+_supabase = httpx.AsyncClient(
+    base_url=f"{DATABASE_URL.rstrip('/')}/rest/v1",
+    headers=SUPABASE_HEADERS,
+    timeout=10.0,
+    transport=_RetryTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    ),
+)
 
 
 def allowed(update: Update) -> bool:
     return update.message.from_user.id in ALLOWED_USERS
 
+
+# (local YYYY-MM-DD, epoch second at which the next local day starts)
+_today_cache: tuple[str, float] = ("", 0.0)
+
+
+def _today() -> str:
+    """Today's date in LOCAL_TZ, recomputed only when the day rolls over."""
+    global _today_cache
+    date, expires = _today_cache
+    if time.time() >= expires:
+        now = datetime.now(LOCAL_TZ)
+        date = now.strftime("%Y-%m-%d")
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        _today_cache = (date, midnight.timestamp())
+    return date
+
 # ---------------------------------------------------------------------------
 # Wiki parsing prompt
 # ---------------------------------------------------------------------------
@@ -62,26 +174,21 @@ RULES:
 - If ambiguous, set needs_clarification: true.
 
 OUTPUT SCHEMA:
-{{
+{
   "operation": "create" | "update" | "delete",
   "title": "Page Title",
   "content": "markdown content...",
   "append": false,
   "needs_clarification": false,
   "clarification_question": null
-}}
-
-Now parse this message:
-\"\"\"{message}\"\"\"
+}
 """
 
 # ---------------------------------------------------------------------------
 # Parsing prompt — tightly scoped to 3 categories
 # ---------------------------------------------------------------------------
 PARSING_PROMPT = """You are a structured-data extraction engine for a personal dashboard.
-Your ONLY job is to return valid JSON — no commentary, no markdown fences.
-
-Today's date: {current_date}
+Your ONLY job is to call the log_entry tool with the parsed entry — no commentary.
 
 ACTIONS:
 - "add" (default): log a new entry
@@ -138,8 +245,8 @@ CATEGORIES (pick exactly one):
    - "sick leave today" → kind: "taken", days: 1, leave_type: "sick"
 
 RULES:
-- Return ONLY a single JSON object. No markdown, no explanation.
-- Current datetime: {current_datetime} (timezone: Asia/Singapore, UTC+8)
+- Call log_entry exactly once. No explanation.
+- Today's date and the current datetime (timezone: Asia/Singapore, UTC+8) are given with the message.
 - All dates must be YYYY-MM-DD. Resolve relative dates (e.g. "Friday" → next Friday).
 - If "yesterday" is mentioned, subtract 1 day from today.
 - Currency is always SGD — do not include a currency field.
@@ -148,40 +255,64 @@ RULES:
   "category": "unknown", "needs_clarification": true, "clarification_question": "<your question>"
 
 OUTPUT SCHEMA:
-{{
+{
   "action": "add" | "remove",
   "category": "spending" | "net_worth" | "todos" | "sleep" | "leave" | "unknown",
-  "data": {{ ... }},
+  "data": { ... },
   "confidence": 0.0-1.0,
   "needs_clarification": false,
   "clarification_question": null
-}}
-
-Now parse this message:
-\"\"\"{message}\"\"\"
+}
 """
 
 
+def _parsing_prompt_tail(current_date: str, current_datetime: str, message: str) -> str:
+    """Per-message tail, sent after the cached PARSING_PROMPT block.
+
+    Keeping the date out of the prefix means the cache survives across days.
+    """
+    return (
+        f"Today's date: {current_date}\n"
+        f"Current datetime: {current_datetime}\n\n"
+        "Now parse this message:\n"
+        f'"""{message}"""\n'
+    )
+
+
+# Claude is forced to answer through this tool, so the parse arrives as an
+# already-decoded object instead of text that needs fence stripping.
+PARSE_TOOL = {
+    "name": "log_entry",
+    "description": "Record the structured parse of the user's message.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": ["add", "remove"]},
+            "category": {
+                "type": "string",
+                "enum": ["spending", "net_worth", "todos", "sleep", "leave", "unknown"],
+            },
+            "data": {"type": "object"},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+            "needs_clarification": {"type": "boolean"},
+            "clarification_question": {"type": ["string", "null"]},
+        },
+        "required": ["action", "category", "data", "confidence", "needs_clarification"],
+    },
+}
+
+
 # ---------------------------------------------------------------------------
 # Validation schemas — enforce required fields per category
 # ---------------------------------------------------------------------------
 REQUIRED_FIELDS = {
     "spending": {"amount", "description", "subcategory"},
-    "net_worth": set(),     # at least one of savings/trading, validated below
+    "net_worth": set(),     # at least one of savings/trading, see _DATA_RULES
     "todos": {"task", "priority", "status"},
     "sleep": {"score"},
     "leave": {"kind", "days"},
 }
 
-# For remove actions, we only need enough to identify the entry
-REQUIRED_FIELDS_REMOVE = {
-    "spending": set(),       # any combination of amount/description/date is fine
-    "net_worth": set(),
-    "todos": set(),
-    "sleep": set(),
-    "leave": set(),
-}
-
 VALID_ENUMS = {
     "todos": {
         "priority": {"high", "medium", "low"},
@@ -194,99 +325,268 @@ VALID_ENUMS = {
 }
 
 
+# Type, range and cross-field rules layered on top of the two tables above.
+_DATA_RULES = {
+    "spending": {"properties": {"amount": {"type": "number", "exclusiveMinimum": 0}}},
+    "net_worth": {"anyOf": [
+        {"required": ["savings"], "properties": {"savings": {"type": "number"}}},
+        {"required": ["trading"], "properties": {"trading": {"type": "number"}}},
+    ]},
+    "sleep": {"properties": {"score": {"type": "number", "minimum": 0, "maximum": 10}}},
+    "leave": {
+        "properties": {"days": {"type": "number", "minimum": 0}},
+        # Leave taken must be more than 0 days
+        "if": {"properties": {"kind": {"const": "taken"}}},
+        "then": {"properties": {"days": {"exclusiveMinimum": 0}}},
+    },
+}
+
+
+def _data_schema(category: str) -> dict:
+    # Claude often sends an explicit null (or "") for an optional field it
+    # has no value for; that's "not given", not an invalid choice.
+    enums = {
+        field: {"enum": sorted(allowed) + ([] if field in REQUIRED_FIELDS[category] else [None, ""])}
+        for field, allowed in VALID_ENUMS.get(category, {}).items()
+    }
+    return {
+        "type": "object",
+        "required": sorted(REQUIRED_FIELDS[category]),
+        "allOf": [{"properties": enums}, _DATA_RULES.get(category, {})],
+    }
+
+
+# Removes only need a known category — any fields that identify the entry
+# will do. Adds must satisfy their category's data schema.
+PARSED_SCHEMA = {
+    "type": "object",
+    "required": ["category"],
+    "properties": {
+        "category": {"enum": sorted(REQUIRED_FIELDS)},
+        "data": {"type": "object"},
+    },
+    "if": {"required": ["action"], "properties": {"action": {"const": "remove"}}},
+    "else": {
+        "required": ["data"],
+        "allOf": [
+            {
+                "if": {"properties": {"category": {"const": category}}},
+                "then": {"properties": {"data": _data_schema(category)}},
+            }
+            for category in REQUIRED_FIELDS
+        ],
+    },
+}
+
+_validate_parsed_schema = fastjsonschema.compile(PARSED_SCHEMA)
+
+
 def validate_parsed(parsed: dict) -> tuple[bool, str]:
     """Validate parsed data against the schema. Returns (is_valid, error_message)."""
-    category = parsed.get("category")
-    action = parsed.get("action", "add")
+    try:
+        _validate_parsed_schema(parsed)
+    except fastjsonschema.JsonSchemaException as e:
+        return False, e.message
+    return True, ""
 
-    required_map = REQUIRED_FIELDS_REMOVE if action == "remove" else REQUIRED_FIELDS
-    if category not in required_map:
-        return False, f"Unknown category: {category}"
-
-    data = parsed.get("data", {})
-    missing = required_map[category] - set(data.keys())
-    if missing:
-        return False, f"Missing fields for {category}: {missing}"
-
-    # Only validate enums for add actions
-    if action == "add":
-        for field, allowed in VALID_ENUMS.get(category, {}).items():
-            value = data.get(field)
-            if value and value not in allowed:
-                return False, f"Invalid {field}='{value}' for {category}. Allowed: {allowed}"
-
-        # Spending: amount must be a positive number
-        if category == "spending":
-            amount = data.get("amount")
-            if not isinstance(amount, (int, float)) or amount <= 0:
-                return False, f"Invalid amount: {amount}"
-
-        # Net worth: must have at least one of savings or trading
-        if category == "net_worth":
-            has_savings = isinstance(data.get("savings"), (int, float))
-            has_trading = isinstance(data.get("trading"), (int, float))
-            if not has_savings and not has_trading:
-                return False, "net_worth requires at least one of: savings, trading"
-
-        # Sleep: score must be 0-10
-        if category == "sleep":
-            score = data.get("score")
-            if not isinstance(score, (int, float)) or score < 0 or score > 10:
-                return False, f"Invalid sleep score: {score} (must be 0-10)"
-
-        # Leave: days must be a non-negative number; taken must be > 0
-        if category == "leave":
-            days = data.get("days")
-            if not isinstance(days, (int, float)) or days < 0:
-                return False, f"Invalid leave days: {days}"
-            if data.get("kind") == "taken" and days == 0:
-                return False, "Leave taken must be more than 0 days"
 
-    return True, ""
+# ---------------------------------------------------------------------------
+# Local fast path — fixed-format messages that don't need Claude
+# ---------------------------------------------------------------------------
+_SLEEP_RE = re.compile(r"sleep (\d+(?:\.\d+)?)(?: ?/ ?10)?(?:[,:]? (.+))?", re.IGNORECASE)
+_ACCOUNT_RE = re.compile(r"(savings|trading)(?: acc(?:ount)?)? \$?(\d[\d,]*(?:\.\d+)?)(k)?", re.IGNORECASE)
+_ACCOUNT_SEP = re.compile(r" ?(?:,| and) ?(?=[a-z])", re.IGNORECASE)
+_LEAVE_BALANCE_RE = re.compile(r"leave balance (\d+(?:\.\d+)?)(?: days?)?", re.IGNORECASE)
+
+
+def _to_number(digits: str, thousands: bool = False) -> int | float | None:
+    """None when out of int64 range (orjson can't encode it): Claude decides."""
+    value = float(digits.replace(",", "")) * (1000 if thousands else 1)
+    if not abs(value) < 2 ** 63:   # also catches inf
+        return None
+    return int(value) if value.is_integer() else value
+
+
+def _fast_parse(message_text: str) -> dict | None:
+    """Parse "sleep 7.5", "savings 15k, trading 8k" or "leave balance 18.5"
+    locally. Returns None for anything else, which then goes to Claude."""
+    text = " ".join(message_text.split())
+
+    if m := _SLEEP_RE.fullmatch(text):
+        data = {"score": _to_number(m[1])}
+        if m[2]:
+            data["notes"] = m[2]
+        category = "sleep"
+
+    elif m := _LEAVE_BALANCE_RE.fullmatch(text):
+        data = {"kind": "balance", "days": _to_number(m[1])}
+        category = "leave"
+
+    else:
+        data = {}
+        for part in _ACCOUNT_SEP.split(text):
+            m = _ACCOUNT_RE.fullmatch(part)
+            if not m or m[1].lower() in data:
+                return None
+            data[m[1].lower()] = _to_number(m[2], thousands=bool(m[3]))
+        category = "net_worth"
+
+    if None in data.values():
+        return None
+    return {
+        "action": "add",
+        "category": category,
+        "data": data,
+        "confidence": 1.0,
+        "needs_clarification": False,
+    }
 
 
 # ---------------------------------------------------------------------------
 # Claude API — parse message
 # ---------------------------------------------------------------------------
+class _RateLimiter:
+    """Token bucket allowing `rate` acquisitions per `period` seconds."""
+
+    def __init__(self, rate: int, period: float):
+        self._rate = rate
+        self._period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate / self._period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self._period / self._rate)
+
+
+# Shared by every Claude call so bursts queue here instead of tripping 429s.
+_claude_limiter = _RateLimiter(CLAUDE_RPM, 60.0)
+_claude_slots = asyncio.Semaphore(5)  # max Claude requests in flight
+CLAUDE_ATTEMPTS = 4
+CLAUDE_MAX_RETRY_WAIT = 8.0  # seconds; a longer Retry-After fails fast instead
+
+
+async def _claude_post(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """POST to Claude within the rate limit, retrying 429s and 5xx.
+
+    Waits for the server's Retry-After if it sends one (giving up if that is
+    over CLAUDE_MAX_RETRY_WAIT, as the caller may hold a user lock), otherwise
+    backs off exponentially. The final response is returned whatever its status.
+    """
+    for attempt in range(CLAUDE_ATTEMPTS):
+        await _claude_limiter.acquire()
+        async with _claude_slots:
+            resp = await client.post(url, **kwargs)
+        if (resp.status_code != 429 and resp.status_code < 500) or attempt == CLAUDE_ATTEMPTS - 1:
+            return resp
+        try:
+            delay = float(resp.headers.get("retry-after", 2 ** attempt))
+        except ValueError:
+            delay = 2 ** attempt
+        if delay > CLAUDE_MAX_RETRY_WAIT:
+            logger.warning("Claude API %s, Retry-After %.0fs too long; giving up", resp.status_code, delay)
+            return resp
+        logger.warning("Claude API %s, retrying in %.1fs", resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+
+def _strip_fences(text: str) -> str:
+    """Remove the Markdown fence Claude occasionally wraps its JSON in."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.removeprefix("```").removeprefix("json").lstrip()
+    return text.removesuffix("```").rstrip()
+
+
+def _parse_json_reply(text: str):
+    """Decode a JSON text reply, stripping fences only if a plain decode fails."""
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return orjson.loads(_strip_fences(text))
+
+
+PARSE_CACHE_SIZE = 1024
+
+# (normalised message, local date) -> validated parse, most recent last.
+# Exact repeats like "coffee $5" skip the Claude round-trip entirely.
+_parse_cache: OrderedDict[tuple[str, str], dict] = OrderedDict()
+
+
+def _normalise(message_text: str) -> str:
+    """Cache key form: runs of whitespace collapsed. Case is kept, since the
+    parse copies the user's wording into fields like description and task."""
+    return " ".join(message_text.split())
+
+
+def _cache_parse(key: tuple[str, str], parsed: dict):
+    """Remember a confident parse. Reminders are skipped: "in 2 hours"
+    resolves differently every time even on the same day."""
+    if parsed.get("confidence", 0) < 0.9 or "reminder_time" in parsed.get("data", {}):
+        return
+    _parse_cache[key] = copy.deepcopy(parsed)
+    if len(_parse_cache) > PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)
+
+
 async def parse_with_claude(message_text: str) -> dict:
-    """Send the message to Claude for structured extraction."""
-    now = datetime.now(LOCAL_TZ)
-    current_date = now.strftime("%Y-%m-%d")
-    current_datetime = now.isoformat()
-    prompt = PARSING_PROMPT.format(
-        current_date=current_date,
-        current_datetime=current_datetime,
-        message=message_text,
-    )
+    """Send the message to Claude for structured extraction (fixed-format
+    messages are parsed locally first)."""
+    current_date = _today()
+
+    fast = _fast_parse(message_text)
+    if fast is not None and validate_parsed(fast)[0]:
+        _apply_defaults(fast, current_date)
+        return fast
+
+    cache_key = (_normalise(message_text), current_date)
+    cached = _parse_cache.get(cache_key)
+    if cached is not None:
+        _parse_cache.move_to_end(cache_key)
+        return copy.deepcopy(cached)
+
+    return await _claude_parse(message_text, current_date, cache_key)
+
+
+async def _claude_parse(message_text: str, current_date: str, cache_key: tuple[str, str]) -> dict:
+    """Ask Claude for the parse; confident results are cached under cache_key."""
+    prompt = _parsing_prompt_tail(current_date, datetime.now(LOCAL_TZ).isoformat(), message_text)
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={
-                    "x-api-key": ANTHROPIC_API_KEY,
-                    "anthropic-version": "2023-06-01",
-                    "content-type": "application/json",
-                },
-                json={
-                    "model": "claude-haiku-4-5-20251001",
-                    "max_tokens": 512,
-                    "temperature": 0,          # deterministic parsing
-                    "messages": [{"role": "user", "content": prompt}],
-                },
-            )
+        resp = await _claude_post(
+            _anthropic,
+            "/messages",
+            json={
+                "model": "claude-haiku-4-5-20251001",
+                "max_tokens": 256,        # a parse is ~100-200 tokens
+                "temperature": 0,          # deterministic parsing
+                # Static instructions as the system prompt; only the short
+                # tail below changes per message. (Too short for Anthropic's
+                # prompt cache, so no cache_control.)
+                "system": PARSING_PROMPT,
+                "tools": [PARSE_TOOL],
+                "tool_choice": {"type": "tool", "name": PARSE_TOOL["name"]},
+                "messages": [{"role": "user", "content": prompt}],
+            },
+        )
 
         if resp.status_code != 200:
-            print(f"❌ Claude API {resp.status_code}: {resp.text}")
+            logger.error("Claude API %s: %s", resp.status_code, resp.text)
             return _error_response("Sorry, I had trouble processing that. Could you try again?")
 
-        content = resp.json()["content"][0]["text"].strip()
-
-        # Strip markdown fences if Claude accidentally adds them
-        content = re.sub(r"^```(?:json)?\s*", "", content)
-        content = re.sub(r"\s*```$", "", content)
-
-        parsed = json.loads(content)
+        parsed = next(
+            block["input"]
+            for block in orjson.loads(resp.content)["content"]
+            if block["type"] == "tool_use"
+        )
 
         # Validate
         if parsed.get("needs_clarification"):
@@ -294,18 +594,16 @@ async def parse_with_claude(message_text: str) -> dict:
 
         is_valid, err = validate_parsed(parsed)
         if not is_valid:
-            print(f"⚠️  Validation failed: {err}")
+            logger.warning("Validation failed: %s", err)
             return _error_response("I wasn't sure how to categorise that. Could you rephrase?")
 
         # Inject defaults
-        _apply_defaults(parsed)
+        _apply_defaults(parsed, current_date)
+        _cache_parse(cache_key, parsed)
         return parsed
 
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON parse error: {e}\nRaw content: {content!r}")
-        return _error_response("I couldn't understand that. Could you rephrase?")
     except Exception as e:
-        print(f"❌ Unexpected error in parse_with_claude: {e}")
+        logger.exception("Unexpected error in parse_with_claude: %s", e)
         return _error_response("Something went wrong. Please try again.")
 
 
@@ -317,157 +615,203 @@ def _error_response(question: str) -> dict:
     }
 
 
-def _apply_defaults(parsed: dict):
-    """Fill in sensible defaults for optional fields."""
-    data = parsed.get("data", {})
-    today = datetime.now().strftime("%Y-%m-%d")
+# Categories whose entries default to today's date.
+_DATED_CATEGORIES = {"spending", "net_worth", "sleep", "leave"}
 
-    if parsed["category"] == "spending":
-        data.setdefault("date", today)
 
-    elif parsed["category"] == "net_worth":
+def _apply_defaults(parsed: dict, today: str):
+    """Fill in sensible defaults for optional fields, dating entries `today`.
+
+    Also runs for removes, which are only validated for a known category, so
+    data and its fields may be missing."""
+    data = parsed.setdefault("data", {})
+    category = parsed["category"]
+
+    if category in _DATED_CATEGORIES:
         data.setdefault("date", today)
 
-    elif parsed["category"] == "todos":
+    if category == "todos":
         data.setdefault("status", "pending")
         data.setdefault("tags", [])
+        # A reminder time without an offset means local time. Store it with
+        # the offset so the reminder_time column and the bot's wake-up agree.
+        try:
+            when = datetime.fromisoformat(data["reminder_time"])
+        except (KeyError, ValueError, TypeError):
+            pass
+        else:
+            if when.tzinfo is None:
+                data["reminder_time"] = when.replace(tzinfo=LOCAL_TZ).isoformat()
 
-    elif parsed["category"] == "sleep":
-        data.setdefault("date", today)
-
-    elif parsed["category"] == "leave":
-        data.setdefault("date", today)
-        if data.get("kind") == "taken":
-            data.setdefault("leave_type", "annual")
+    elif category == "leave" and data.get("kind") == "taken":
+        if not data.get("leave_type"):   # absent, null or ""
+            data["leave_type"] = "annual"
 
 
 # ---------------------------------------------------------------------------
 # Supabase persistence
 # ---------------------------------------------------------------------------
-async def save_to_supabase(category: str, data: dict, user_id: int) -> bool:
-    """Insert a row into the single dashboard_entries table."""
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.25          # seconds a partial batch waits for more rows
+WRITE_ATTEMPTS = 3
+
+# How an insert ended, as reported by _insert_rows.
+WRITE_SAVED = "saved"
+WRITE_REJECTED = "rejected"     # Supabase refused the rows; resending can't help
+WRITE_NOT_SENT = "not_sent"     # definitely not written (unreachable, or 429/503)
+WRITE_UNCERTAIN = "uncertain"   # may have been written: replaying could duplicate
+
+# (row, future) pairs waiting for _write_flusher; the future resolves to
+# whether the row was saved. None tells the flusher to stop.
+_write_queue: asyncio.Queue[tuple[dict, asyncio.Future] | None] = asyncio.Queue()
+_flusher_task: asyncio.Task | None = None
+
+
+async def save_to_supabase(category: str, data: dict, user_id: int) -> str:
+    """Save a row to the single dashboard_entries table.
+
+    The row is queued and _write_flusher inserts it within
+    WRITE_FLUSH_INTERVAL, batched with anything else that arrived; this
+    returns the insert's WRITE_* outcome once it is known."""
     row = {
         "user_id": str(user_id),
         "category": category,
         "data": data,       # jsonb column: store the native object (PostgREST encodes it)
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),  # orjson writes RFC 3339
     }
+    saved = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((row, saved))
+    return await saved
+
+
+async def _insert_rows(rows: list[dict]) -> str:
+    """Insert rows with one PostgREST bulk POST. Returns a WRITE_* outcome.
 
+    Inserts aren't idempotent, so only failures that certainly wrote nothing
+    are retried (with backoff; the flusher just holds the batch meanwhile):
+    no connection, 429 and 503. A timeout or error after the body went out,
+    or any other 5xx, may have committed and is reported as uncertain."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=representation",
-                },
-                json=row,
+        body = orjson.dumps(rows)
+    except TypeError as e:  # e.g. an int beyond 64 bits
+        logger.error("Can't encode %d row(s): %s", len(rows), e)
+        return WRITE_REJECTED
+    for attempt in range(WRITE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(2 ** attempt)
+        try:
+            resp = await _supabase.post(
+                f"/{TABLE_NAME}",
+                headers=SUPABASE_WRITE_HEADERS,
+                content=body,
             )
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            logger.warning("Supabase unreachable: %s", e)
+            continue
+        except Exception as e:
+            logger.error("Supabase request failed: %s", e)
+            return WRITE_UNCERTAIN
 
         if resp.status_code in (200, 201):
-            print(f"✅ Saved to Supabase: {category}")
-            return True
-        else:
-            print(f"❌ Supabase error {resp.status_code}: {resp.text}")
-            return False
-
-    except Exception as e:
-        print(f"❌ Supabase request failed: {e}")
-        return False
+            logger.info("Saved %d row(s) to Supabase", len(rows))
+            return WRITE_SAVED
+        logger.error("Supabase error %s: %s", resp.status_code, resp.text)
+        if resp.status_code not in (429, 503):
+            return WRITE_UNCERTAIN if resp.status_code >= 500 else WRITE_REJECTED
+
+    logger.error("Gave up on %d row(s) after %d attempts", len(rows), WRITE_ATTEMPTS)
+    return WRITE_NOT_SENT
+
+
+async def _write_batch(batch: list[tuple[dict, asyncio.Future]]):
+    """Insert a batch and resolve each row's future with the WRITE_* outcome."""
+    outcome = await _insert_rows([row for row, _ in batch])
+    if outcome == WRITE_REJECTED and len(batch) > 1:
+        # PostgREST rejects the whole bulk insert for one bad row: retry the
+        # rows one by one so only that row fails.
+        for item in batch:
+            await _write_batch([item])
+        return
+    for _, saved in batch:
+        if not saved.done():
+            saved.set_result(outcome)
+
+
+async def _write_flusher():
+    """Drain _write_queue in batches of up to WRITE_BATCH_SIZE rows."""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _write_queue.get()
+        if item is None:
+            _write_queue.task_done()
+            return
+        batch = [item]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        stop = False
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_write_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                _write_queue.task_done()
+                stop = True
+                break
+            batch.append(item)
+        try:
+            await _write_batch(batch)
+        except Exception as e:
+            # Never let one batch take the flusher (and every later save) down.
+            logger.error("Write batch failed: %s", e)
+        finally:
+            for _, saved in batch:
+                if not saved.done():
+                    saved.set_result(WRITE_UNCERTAIN)
+                _write_queue.task_done()
+        if stop:
+            return
 
 
 async def remove_from_supabase(category: str, data: dict, user_id: int) -> dict | None:
     """Find and delete a matching entry. Returns the deleted entry or None."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Fetch recent entries in this category to find a match
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={
-                    "user_id": f"eq.{str(user_id)}",
-                    "category": f"eq.{category}",
-                    "order": "created_at.desc",
-                    "limit": "50",
-                    "select": "id,category,data,created_at",
-                },
-            )
-
-            if resp.status_code != 200 or not resp.json():
-                return None
-
-            rows = resp.json()
-
-            # Find best matching entry
-            match = _find_best_match(category, data, rows)
-            if not match:
-                return None
-
-            # Delete it
-            del_resp = await client.delete(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={"id": f"eq.{match['id']}"},
-            )
+        # Matched, scored and deleted in one call (see remove_matching_entry
+        # in SETUP.md); the deleted row comes back, or nothing if no match.
+        resp = await _supabase.post(
+            "/rpc/remove_matching_entry",
+            json={"uid": user_id, "cat": category, "search": data},
+        )
 
-            if del_resp.status_code in (200, 204):
-                return match
-            return None
+        deleted = orjson.loads(resp.content) if resp.status_code == 200 else []
+        return deleted[0] if deleted else None
 
     except Exception as e:
-        print(f"❌ Supabase remove failed: {e}")
+        logger.error("Supabase remove failed: %s", e)
         return None
 
 
-def _find_best_match(category: str, search: dict, rows: list[dict]) -> dict | None:
-    """Score rows against search criteria and return the best match."""
-    best_row = None
-    best_score = 0
-
-    for row in rows:
-        row_data = row["data"] if isinstance(row["data"], dict) else json.loads(row["data"])
-        score = 0
-
-        if category == "spending":
-            if search.get("amount") and row_data.get("amount") == search["amount"]:
-                score += 3
-            if search.get("description") and search["description"].lower() in row_data.get("description", "").lower():
-                score += 2
-            if search.get("subcategory") and row_data.get("subcategory") == search["subcategory"]:
-                score += 1
-            if search.get("date") and row_data.get("date") == search["date"]:
-                score += 1
-
-        if score > best_score:
-            best_score = score
-            best_row = row
-
-    return best_row if best_score > 0 else None
-
-
 # ---------------------------------------------------------------------------
 # Prospect helpers
 # ---------------------------------------------------------------------------
 async def find_prospect(user_id: int, name: str) -> dict | None:
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/prospects",
-                headers={"apikey": DATABASE_KEY, "Authorization": f"Bearer {DATABASE_KEY}"},
-                params={"user_id": f"eq.{user_id}", "name": f"ilike.{name}", "archived": "eq.false"},
-            )
-        rows = resp.json() if resp.status_code == 200 else []
+        resp = await _supabase.get(
+            "/prospects",
+            params={
+                "user_id": f"eq.{user_id}",
+                "name": f"ilike.{name}",
+                "archived": "eq.false",
+                "select": "id,name",   # callers only need these; skip notes/logs
+                "limit": "1",
+            },
+        )
+        rows = orjson.loads(resp.content) if resp.status_code == 200 else []
         return rows[0] if rows else None
     except Exception as e:
-        print(f"❌ find_prospect error: {e}")
+        logger.error("find_prospect error: %s", e)
         return None
 
 
@@ -482,20 +826,14 @@ async def create_prospect(user_id: int, name: str, stage: str, notes: str | None
         "archived": False,
     }
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(
-                f"{DATABASE_URL}/rest/v1/prospects",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=minimal",
-                },
-                json=row,
-            )
+        resp = await _supabase.post(
+            "/prospects",
+            headers=SUPABASE_WRITE_HEADERS,
+            json=row,
+        )
         return resp.status_code in (200, 201)
     except Exception as e:
-        print(f"❌ create_prospect error: {e}")
+        logger.error("create_prospect error: %s", e)
         return False
 
 
@@ -504,21 +842,15 @@ async def update_prospect_notes(user_id: int, prospect_id: str, notes: str, rati
     if rating is not None:
         update["rating"] = rating
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.patch(
-                f"{DATABASE_URL}/rest/v1/prospects",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=minimal",
-                },
-                params={"id": f"eq.{prospect_id}"},
-                json=update,
-            )
+        resp = await _supabase.patch(
+            "/prospects",
+            headers=SUPABASE_WRITE_HEADERS,
+            params={"id": f"eq.{prospect_id}"},
+            json=update,
+        )
         return resp.status_code in (200, 204)
     except Exception as e:
-        print(f"❌ update_prospect_notes error: {e}")
+        logger.error("update_prospect_notes error: %s", e)
         return False
 
 
@@ -543,38 +875,31 @@ Rating guide (based on HER messages only):
 4.0-4.5 = high engagement, asks questions, enthusiasm
 5.0 = exceptional, initiates topics, suggests meetups"""
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        resp = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            },
-            json={
-                "model": "claude-haiku-4-5-20251001",
-                "max_tokens": 1024,
-                "messages": [{
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": image_b64}},
-                        {"type": "text", "text": prompt},
-                    ],
-                }],
-            },
-        )
+    resp = await _claude_post(
+        _anthropic,
+        "/messages",
+        timeout=60.0,  # image analysis runs longer than a parse
+        json={
+            "model": "claude-haiku-4-5-20251001",
+            "max_tokens": 1024,
+            "messages": [{
+                "role": "user",
+                "content": [
+                    {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": image_b64}},
+                    {"type": "text", "text": prompt},
+                ],
+            }],
+        },
+    )
 
     if resp.status_code != 200:
         raise Exception(f"Claude API {resp.status_code}: {resp.text}")
 
-    text = resp.json()["content"][0]["text"].strip()
-    text = re.sub(r"^```(?:json)?\s*", "", text)
-    text = re.sub(r"\s*```$", "", text)
-    return json.loads(text)
+    return _parse_json_reply(orjson.loads(resp.content)["content"][0]["text"])
 
 
 async def _process_conversation_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE, image_b64: str, name: str, user_id: int):
-    await update.message.chat.send_action("typing")
+    context.application.create_task(update.message.chat.send_action("typing"))
 
     prospect = await find_prospect(user_id, name)
 
@@ -617,6 +942,26 @@ async def _process_conversation_screenshot(update: Update, context: ContextTypes
 # ---------------------------------------------------------------------------
 # Telegram handlers
 # ---------------------------------------------------------------------------
+# Updates are processed concurrently (see main), but each user's messages,
+# photos and data commands go through one at a time, in order: the pending_*
+# flows in user_data stay consistent, /delete can't overtake the message
+# before it, and a burst becomes a queue (repeats then hit the parse cache)
+# rather than parallel Claude calls. Different users don't block.
+_user_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _in_user_order(handler):
+    """Run a handler for allowed users only, under the sender's _user_locks
+    entry (checked first, so strangers never get a lock)."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not allowed(update):
+            return
+        async with _user_locks[update.message.from_user.id]:
+            await handler(update, context)
+    return wrapper
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not allowed(update):
         return
@@ -658,161 +1003,108 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@_in_user_order
 async def cmd_recent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Fetch last 5 entries from Supabase."""
-    if not allowed(update):
-        return
     user_id = str(update.message.from_user.id)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={
-                    "user_id": f"eq.{user_id}",
-                    "order": "created_at.desc",
-                    "limit": "5",
-                    "select": "category,data,created_at",
-                },
-            )
+        resp = await _supabase.get(
+            f"/{TABLE_NAME}",
+            params={
+                "user_id": f"eq.{user_id}",
+                "order": "created_at.desc",
+                "limit": "5",
+                "select": "category,data",
+            },
+        )
 
         if resp.status_code != 200:
             await update.message.reply_text("❌ Couldn't fetch recent entries.")
             return
 
-        rows = resp.json()
+        rows = orjson.loads(resp.content)
         if not rows:
             await update.message.reply_text("No entries yet! Send me a message to get started.")
             return
 
         lines = ["📋 *Recent entries:*\n"]
-        emoji_map = {"spending": "💰", "net_worth": "🏦", "todos": "✅", "sleep": "😴", "leave": "🌴"}
         for row in rows:
-            data = row["data"] if isinstance(row["data"], dict) else json.loads(row["data"])
+            data = row["data"]
             cat = row["category"]
-            emoji = emoji_map.get(cat, "📝")
+            emoji = CATEGORY_EMOJI.get(cat, "📝")
             summary = _summarise_entry(cat, data)
             lines.append(f"{emoji} {summary}")
 
         await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
     except Exception as e:
-        print(f"❌ /recent error: {e}")
+        logger.error("/recent error: %s", e)
         await update.message.reply_text("❌ Something went wrong fetching your entries.")
 
 
+@_in_user_order
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show aggregated stats from Supabase."""
-    if not allowed(update):
-        return
+    """Show aggregated stats, computed server-side by the dashboard_stats RPC."""
     user_id = str(update.message.from_user.id)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={
-                    "user_id": f"eq.{user_id}",
-                    "select": "category,data",
-                },
-            )
+        resp = await _supabase.post(
+            "/rpc/dashboard_stats", json={"uid": user_id}, extensions={"idempotent": True}
+        )
 
-        if resp.status_code != 200:
+        rows = orjson.loads(resp.content) if resp.status_code == 200 else []
+        if not rows:
             await update.message.reply_text("❌ Couldn't fetch stats.")
             return
 
-        rows = resp.json()
-        spending_count = 0
-        total_spent = 0.0
-        todos_pending = 0
-
-        for row in rows:
-            data = row["data"] if isinstance(row["data"], dict) else json.loads(row["data"])
-            cat = row["category"]
-            if cat == "spending":
-                spending_count += 1
-                total_spent += data.get("amount", 0)
-            elif cat == "todos":
-                if data.get("status") in ("pending", "in_progress"):
-                    todos_pending += 1
+        stats = rows[0]
+        total_spent = float(stats["total_spent"])
 
         await update.message.reply_text(
             f"📊 *Your Stats*\n\n"
-            f"💰 Spending: {spending_count} entries · ${total_spent:,.2f} spent\n"
-            f"✅ Todos: {todos_pending} pending tasks",
+            f"💰 Spending: {stats['spending_count']} entries · ${total_spent:,.2f} spent\n"
+            f"✅ Todos: {stats['todos_pending']} pending tasks",
             parse_mode="Markdown",
         )
 
     except Exception as e:
-        print(f"❌ /stats error: {e}")
+        logger.error("/stats error: %s", e)
         await update.message.reply_text("❌ Something went wrong fetching stats.")
 
 
+@_in_user_order
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete the most recent entry."""
-    if not allowed(update):
-        return
     user_id = str(update.message.from_user.id)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Fetch the latest entry's id
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={
-                    "user_id": f"eq.{user_id}",
-                    "order": "created_at.desc",
-                    "limit": "1",
-                    "select": "id,category,data",
-                },
-            )
-
-            if resp.status_code != 200 or not resp.json():
-                await update.message.reply_text("Nothing to delete.")
-                return
-
-            entry = resp.json()[0]
-            entry_id = entry["id"]
-
-            # Delete it
-            del_resp = await client.delete(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={"id": f"eq.{entry_id}"},
-            )
+        # Find, delete and return the latest entry in one call
+        resp = await _supabase.post("/rpc/delete_latest", json={"uid": user_id})
 
-        if del_resp.status_code in (200, 204):
-            data = entry["data"] if isinstance(entry["data"], dict) else json.loads(entry["data"])
-            summary = _summarise_entry(entry["category"], data)
-            await update.message.reply_text(f"🗑️ Deleted: {summary}")
-        else:
+        if resp.status_code != 200:
             await update.message.reply_text("❌ Couldn't delete the entry.")
+            return
+
+        deleted = orjson.loads(resp.content)
+        if not deleted:
+            await update.message.reply_text("Nothing to delete.")
+            return
+
+        entry = deleted[0]
+        summary = _summarise_entry(entry["category"], entry["data"])
+        await update.message.reply_text(f"🗑️ Deleted: {summary}")
 
     except Exception as e:
-        print(f"❌ /delete error: {e}")
+        logger.error("/delete error: %s", e)
         await update.message.reply_text("❌ Something went wrong.")
 
 
+@_in_user_order
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle photo messages — conversation screenshot analysis."""
-    if not allowed(update):
-        return
     user_id = update.message.from_user.id
     caption = (update.message.caption or "").strip()
 
-    await update.message.chat.send_action("typing")
+    # Runs alongside the download instead of ahead of it.
+    context.application.create_task(update.message.chat.send_action("typing"))
 
     # Download the largest photo size
     photo = update.message.photo[-1]
@@ -831,35 +1123,27 @@ async def toggle_demo_mode(update: Update, user_id: int):
     """Toggle demo mode on/off."""
     try:
         # Check current state
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={"apikey": DATABASE_KEY, "Authorization": f"Bearer {DATABASE_KEY}"},
-                params={
-                    "user_id": f"eq.{user_id}",
-                    "category": "eq.settings",
-                    "select": "id,data",
-                },
-            )
-        rows = resp.json() if resp.status_code == 200 else []
+        resp = await _supabase.get(
+            f"/{TABLE_NAME}",
+            params={
+                "user_id": f"eq.{user_id}",
+                "category": "eq.settings",
+                "select": "id,data",
+            },
+        )
+        rows = orjson.loads(resp.content) if resp.status_code == 200 else []
         settings_row = rows[0] if rows else None
 
         if settings_row:
-            data = settings_row["data"] if isinstance(settings_row["data"], dict) else json.loads(settings_row["data"])
+            data = settings_row["data"]
             new_demo = not data.get("demo_mode", False)
             data["demo_mode"] = new_demo
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                await client.patch(
-                    f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                    headers={
-                        "apikey": DATABASE_KEY,
-                        "Authorization": f"Bearer {DATABASE_KEY}",
-                        "Content-Type": "application/json",
-                        "Prefer": "return=minimal",
-                    },
-                    params={"id": f"eq.{settings_row['id']}"},
-                    json={"data": data},
-                )
+            await _supabase.patch(
+                f"/{TABLE_NAME}",
+                headers=SUPABASE_WRITE_HEADERS,
+                params={"id": f"eq.{settings_row['id']}"},
+                json={"data": data},
+            )
         else:
             new_demo = True
             await save_to_supabase("settings", {"demo_mode": True}, user_id)
@@ -870,14 +1154,16 @@ async def toggle_demo_mode(update: Update, user_id: int):
             await update.message.reply_text("🎭 Demo mode *OFF*\nAll data visible", parse_mode="Markdown")
 
     except Exception as e:
-        print(f"❌ Demo toggle error: {e}")
+        logger.error("Demo toggle error: %s", e)
         await update.message.reply_text("❌ Failed to toggle demo mode.")
 
 
+_WIKI_RE = re.compile(r"\bwiki\b", re.IGNORECASE)
+
+
+@_in_user_order
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle any text message — parse and store or remove."""
-    if not allowed(update):
-        return
     user_message = update.message.text.strip()
     user_id = update.message.from_user.id
 
@@ -928,8 +1214,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Check for wiki commands first
-    if re.search(r'\bwiki\b', user_message, re.IGNORECASE):
-        await handle_wiki(update, user_message, user_id)
+    if _WIKI_RE.search(user_message):
+        await handle_wiki(update, context, user_message, user_id)
         return
 
     # Check for demo toggle
@@ -937,7 +1223,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await toggle_demo_mode(update, user_id)
         return
 
-    await update.message.chat.send_action("typing")
+    # Cosmetic — don't hold the Claude call up on Telegram's ack.
+    context.application.create_task(update.message.chat.send_action("typing"))
 
     parsed = await parse_with_claude(user_message)
 
@@ -953,195 +1240,241 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     confidence = parsed.get("confidence", 0)
     low_conf = confidence < 0.7
 
-    emoji_map = {"spending": "💰", "net_worth": "🏦", "todos": "✅", "sleep": "😴", "leave": "🌴"}
-    emoji = emoji_map.get(category, "📝")
-
     if action == "remove":
         deleted = await remove_from_supabase(category, data, user_id)
         if deleted:
-            del_data = deleted["data"] if isinstance(deleted["data"], dict) else json.loads(deleted["data"])
+            del_data = deleted["data"]
             summary = _summarise_entry(category, del_data)
             await update.message.reply_text(f"🗑️ Removed: {summary}", parse_mode="Markdown")
         else:
             await update.message.reply_text("❌ Couldn't find a matching entry to remove.")
     else:
-        success = await save_to_supabase(category, data, user_id)
-        if success:
-            summary = _summarise_entry(category, data)
-            reply = f"{emoji} {summary}"
-            if low_conf:
-                reply += "\n\n⚠️ _I'm not fully sure about this — use /delete if it's wrong._"
-            await update.message.reply_text(reply, parse_mode="Markdown")
-        else:
+        # The confirmation goes out while the row is being written; a failed
+        # write gets a follow-up, and one retry if it certainly wrote nothing.
+        outcome, _ = await asyncio.gather(
+            save_to_supabase(category, data, user_id),
+            _send_confirmation(update, category, data, low_conf),
+        )
+        if outcome == WRITE_NOT_SENT:
+            await update.message.reply_text("⚠️ Save failed, retrying...")
+            outcome = await save_to_supabase(category, data, user_id)
+        if outcome == WRITE_UNCERTAIN:
+            await update.message.reply_text("⚠️ Couldn't confirm that was saved — check /recent before sending it again.")
+        elif outcome != WRITE_SAVED:
             await update.message.reply_text("❌ Failed to save. Please try again.")
+        if outcome == WRITE_SAVED and category == "todos" and data.get("reminder_time"):
+            _schedule_reminder_check(context, data["reminder_time"])
 
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
+async def _send_confirmation(update: Update, category: str, data: dict, low_conf: bool):
+    """Reply with the one-liner for a freshly logged entry."""
+    emoji = CATEGORY_EMOJI.get(category, "📝")
+    reply = f"{emoji} {_summarise_entry(category, data)}"
+    if low_conf:
+        reply += "\n\n⚠️ _I'm not fully sure about this — use /delete if it's wrong._"
+    await update.message.reply_text(reply, parse_mode="Markdown")
+
+
+CATEGORY_EMOJI = {"spending": "💰", "net_worth": "🏦", "todos": "✅", "sleep": "😴", "leave": "🌴"}
+PRIORITY_ICONS = {"high": "🔴", "medium": "🟡", "low": "🟢"}
+
+
+def _summarise_spending(data: dict) -> str:
+    subcat = data.get("subcategory")
+    tag = f" `#{subcat}`" if subcat else ""
+    return f"*${data['amount']}* — {data['description']}{tag}"
+
+
+def _summarise_net_worth(data: dict) -> str:
+    parts = []
+    if "savings" in data:
+        parts.append(f"Savings: *${data['savings']:,.0f}*")
+    if "trading" in data:
+        parts.append(f"Trading: *${data['trading']:,.0f}*")
+    total = data.get("savings", 0) + data.get("trading", 0)
+    parts.append(f"Total: *${total:,.0f}*")
+    return " · ".join(parts)
+
+
+def _summarise_todos(data: dict) -> str:
+    icon = PRIORITY_ICONS.get(data["priority"], "⚪")
+    due = data.get("due")
+    due_part = f" (due {due})" if due else ""
+    reminder_part = ""
+    reminder = data.get("reminder_time")
+    if reminder:
+        try:
+            rt = datetime.fromisoformat(reminder).astimezone(LOCAL_TZ)
+            reminder_part = f"\n🔔 Reminder: {rt:%d/%m/%y %I:%M %p}"
+        except (ValueError, TypeError):
+            pass
+    return f"{icon} {data['task']}{due_part}{reminder_part}"
+
+
+def _summarise_sleep(data: dict) -> str:
+    notes = data.get("notes")
+    notes_part = f" — {notes}" if notes else ""
+    return f"*{data['score']}/10*{notes_part}"
+
+
+def _summarise_leave(data: dict) -> str:
+    days = data["days"]
+    if data["kind"] == "balance":
+        return f"Balance set to *{days}* days"
+    start = data.get("date", "")
+    end = data.get("end_date")
+    when = f"{start} → {end}" if end and end != start else start
+    when_part = f" ({when})" if when else ""
+    notes = data.get("notes")
+    notes_part = f" — {notes}" if notes else ""
+    return f"*{days}d* {data.get('leave_type', 'annual')} leave{when_part}{notes_part}"
+
+
+def _summarise_other(data: dict) -> str:
+    return orjson.dumps(data).decode()
+
+
+_SUMMARISERS = {
+    "spending": _summarise_spending,
+    "net_worth": _summarise_net_worth,
+    "todos": _summarise_todos,
+    "sleep": _summarise_sleep,
+    "leave": _summarise_leave,
+}
+
+
 def _summarise_entry(category: str, data: dict) -> str:
-    """Human-readable one-liner for a dashboard entry."""
-    if category == "spending":
-        amt = data.get("amount", 0)
-        desc = data.get("description", "")
-        subcat = data.get("subcategory", "")
-        line = f"*${amt}* — {desc}"
-        if subcat:
-            line += f" `#{subcat}`"
-        return line
-
-    elif category == "net_worth":
-        parts = []
-        if "savings" in data:
-            parts.append(f"Savings: *${data['savings']:,.0f}*")
-        if "trading" in data:
-            parts.append(f"Trading: *${data['trading']:,.0f}*")
-        total = data.get("savings", 0) + data.get("trading", 0)
-        parts.append(f"Total: *${total:,.0f}*")
-        return " · ".join(parts)
-
-    elif category == "todos":
-        task = data.get("task", "untitled task")
-        priority = data.get("priority", "medium")
-        due = data.get("due", "")
-        reminder = data.get("reminder_time", "")
-        priority_icons = {"high": "🔴", "medium": "🟡", "low": "🟢"}
-        icon = priority_icons.get(priority, "⚪")
-        line = f"{icon} {task}"
-        if due:
-            line += f" (due {due})"
-        if reminder:
-            try:
-                rt = datetime.fromisoformat(reminder).astimezone(LOCAL_TZ)
-                line += f"\n🔔 Reminder: {rt.strftime('%d/%m/%y %I:%M %p')}"
-            except (ValueError, TypeError):
-                pass
-        return line
-
-    elif category == "sleep":
-        score = data.get("score", 0)
-        notes = data.get("notes", "")
-        line = f"*{score}/10*"
-        if notes:
-            line += f" — {notes}"
-        return line
-
-    elif category == "leave":
-        days = data.get("days", 0)
-        notes = data.get("notes", "")
-        if data.get("kind") == "balance":
-            return f"Balance set to *{days}* days"
-        leave_type = data.get("leave_type", "annual")
-        start = data.get("date", "")
-        end = data.get("end_date")
-        when = f"{start} → {end}" if end and end != start else start
-        line = f"*{days}d* {leave_type} leave"
-        if when:
-            line += f" ({when})"
-        if notes:
-            line += f" — {notes}"
-        return line
-
-    return json.dumps(data)
+    """Human-readable one-liner for a dashboard entry.
+
+    Every writer (this bot via validate_parsed, and the sidecar) stores each
+    category's required fields, so the formatters index those directly and
+    only use .get for optional ones."""
+    return _SUMMARISERS.get(category, _summarise_other)(data)
 
 
 # ---------------------------------------------------------------------------
 # Wiki system
 # ---------------------------------------------------------------------------
+_SLUG_STRIP = re.compile(r'[^a-z0-9\s-]')
+_SLUG_DASH = re.compile(r'[\s-]+')
+
+# Segments auto-linking must leave alone.
+_PROTECTED = re.compile(
+    r'(```[\s\S]*?```'       # fenced code blocks
+    r'|`[^`]+`'              # inline code
+    r'|\[([^\]]*)\]\([^)]*\))',  # markdown links
+    re.MULTILINE
+)
+
+
 def _slugify(title: str) -> str:
     """Convert title to URL-friendly slug."""
     slug = title.lower().strip()
-    slug = re.sub(r'[^a-z0-9\s-]', '', slug)
-    slug = re.sub(r'[\s-]+', '-', slug)
+    slug = _SLUG_STRIP.sub('', slug)
+    slug = _SLUG_DASH.sub('-', slug)
     return slug
 
 
+WIKI_PARSE_TTL = 300.0               # seconds a wiki parse is reused for
+
+# message -> (monotonic expiry, parse). Repeats within the TTL
+# skip Claude; stale entries are dropped when looked up or on insert.
+_wiki_parse_cache: dict[str, tuple[float, dict]] = {}
+
+
 async def _wiki_parse(message_text: str) -> dict:
     """Parse a wiki command via Claude."""
-    prompt = WIKI_PROMPT.format(message=message_text)
+    # Whitespace-collapsed but case kept: the text may become page content.
+    key = " ".join(message_text.split())
+    now = time.monotonic()
+    hit = _wiki_parse_cache.get(key)
+    if hit is not None:
+        if hit[0] > now:
+            return copy.deepcopy(hit[1])
+        del _wiki_parse_cache[key]
+
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={
-                    "x-api-key": ANTHROPIC_API_KEY,
-                    "anthropic-version": "2023-06-01",
-                    "content-type": "application/json",
-                },
-                json={
-                    "model": "claude-haiku-4-5-20251001",
-                    "max_tokens": 2048,
-                    "messages": [{"role": "user", "content": prompt}],
-                },
-            )
-        body = resp.json()
-        text = body["content"][0]["text"].strip()
-        text = re.sub(r"^```json\s*", "", text)
-        text = re.sub(r"\s*```$", "", text)
-        return json.loads(text)
+        resp = await _claude_post(
+            _anthropic,
+            "/messages",
+            json={
+                "model": "claude-haiku-4-5-20251001",
+                "max_tokens": 2048,
+                # Same split as the entry parser: static instructions as the
+                # system prompt, only the message in the user turn.
+                "system": WIKI_PROMPT,
+                "messages": [{
+                    "role": "user",
+                    "content": f'Now parse this message:\n"""{message_text}"""',
+                }],
+            },
+        )
+        parsed = _parse_json_reply(orjson.loads(resp.content)["content"][0]["text"])
     except Exception as e:
-        print(f"❌ Wiki parse error: {e}")
+        logger.error("Wiki parse error: %s", e)
         return {"needs_clarification": True, "clarification_question": "Sorry, I couldn't understand that wiki command."}
 
+    if not parsed.get("needs_clarification"):
+        _wiki_parse_cache[key] = (now + WIKI_PARSE_TTL, copy.deepcopy(parsed))
+        if len(_wiki_parse_cache) > PARSE_CACHE_SIZE:
+            for stale in [k for k, (expires, _) in _wiki_parse_cache.items() if expires <= now]:
+                del _wiki_parse_cache[stale]
+    return parsed
+
 
-async def _wiki_get_all_pages(user_id: int) -> list:
-    """Fetch all wiki pages for a user."""
+async def _wiki_get_all_pages(user_id: int) -> list | None:
+    """Fetch all wiki pages for a user. None if the fetch failed."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                headers={"apikey": DATABASE_KEY, "Authorization": f"Bearer {DATABASE_KEY}"},
-                params={"user_id": f"eq.{user_id}", "select": "id,title,slug,content"},
-            )
-        return resp.json() if resp.status_code == 200 else []
+        resp = await _supabase.get(
+            f"/{WIKI_TABLE}",
+            params={"user_id": f"eq.{user_id}", "select": "id,title,slug,content,content_rendered"},
+        )
+        if resp.status_code == 200:
+            return orjson.loads(resp.content)
+        logger.error("Wiki fetch failed: %s %s", resp.status_code, resp.text)
     except Exception as e:
-        print(f"❌ Wiki fetch error: {e}")
-        return []
+        logger.error("Wiki fetch error: %s", e)
+    return None
 
 
-async def _wiki_get_page(user_id: int, slug: str) -> dict | None:
-    """Fetch a single wiki page by slug."""
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                headers={"apikey": DATABASE_KEY, "Authorization": f"Bearer {DATABASE_KEY}"},
-                params={"user_id": f"eq.{user_id}", "slug": f"eq.{slug}", "select": "*"},
-            )
-        rows = resp.json() if resp.status_code == 200 else []
-        return rows[0] if rows else None
-    except Exception:
-        return None
+def _find_page(pages: list, slug: str) -> dict | None:
+    return next((page for page in pages if page["slug"] == slug), None)
 
 
-def _render_links(content: str, all_pages: list, current_slug: str) -> str:
-    """Auto-link page titles in content. Longest match first. Avoids self-links,
-    code blocks, inline code, and existing markdown links."""
-    if not all_pages or not content:
-        return content
+def _title_index(pages: list) -> tuple[re.Pattern | None, dict[str, str]]:
+    """Build the auto-linker for a set of pages, once per render.
 
-    # Sort titles by length descending (longest match first)
-    titles = sorted(
-        [(p["title"], p["slug"]) for p in all_pages if p["slug"] != current_slug],
-        key=lambda t: len(t[0]),
-        reverse=True,
-    )
+    One alternation over every title (longest first, so the longest title wins
+    at any position), word boundaries, case-insensitive, plus a lower-cased
+    title -> slug lookup. Titles differing only in case share a slug, so the
+    lookup is unambiguous.
+    """
+    titles = sorted((p["title"] for p in pages if p["title"]), key=len, reverse=True)
     if not titles:
+        return None, {}
+    slug_by_title = {p["title"].lower(): p["slug"] for p in pages if p["title"]}
+    pattern = re.compile(
+        r'(?<!\w)(' + '|'.join(re.escape(title) for title in titles) + r')(?!\w)',
+        re.IGNORECASE,
+    )
+    return pattern, slug_by_title
+
+
+def _render_links(content: str, index: tuple[re.Pattern | None, dict[str, str]], current_slug: str) -> str:
+    """Auto-link page titles in content using a _title_index. Longest match
+    first. Avoids self-links, code blocks, inline code, and existing markdown links."""
+    title_pattern, slug_by_title = index
+    if title_pattern is None or not content:
         return content
 
     # Split content into protected and unprotected segments
-    # Protected: code blocks, inline code, existing links
-    protected_pattern = re.compile(
-        r'(```[\s\S]*?```'       # fenced code blocks
-        r'|`[^`]+`'              # inline code
-        r'|\[([^\]]*)\]\([^)]*\)'  # markdown links
-        r')',
-        re.MULTILINE
-    )
-
+    # Protected: code blocks, inline code, existing links (see _PROTECTED)
     parts = []
     last_end = 0
-    for match in protected_pattern.finditer(content):
+    for match in _PROTECTED.finditer(content):
         # Process unprotected text before this match
         if match.start() > last_end:
             parts.append(("text", content[last_end:match.start()]))
@@ -1151,49 +1484,62 @@ def _render_links(content: str, all_pages: list, current_slug: str) -> str:
     if last_end < len(content):
         parts.append(("text", content[last_end:]))
 
+    # The index is shared by every page, so the page's own title is still in
+    # the pattern: it matches (and so can't be split into shorter titles) but
+    # is left as plain text. A single pass also means a title can't match
+    # inside a link made for another one.
+    def link(match: re.Match) -> str:
+        slug = slug_by_title[match.group(1).lower()]
+        if slug == current_slug:
+            return match.group(1)
+        return f"[{match.group(1)}](/wiki/{slug})"
+
     # Replace titles in unprotected text segments
     result = []
     for kind, segment in parts:
         if kind == "protected":
             result.append(segment)
         else:
-            for title, slug in titles:
-                # Word boundary match, case-insensitive
-                pattern = re.compile(r'(?<!\w)(' + re.escape(title) + r')(?!\w)', re.IGNORECASE)
-                segment = pattern.sub(f'[\\1](/wiki/{slug})', segment)
-            result.append(segment)
+            result.append(title_pattern.sub(link, segment))
 
     return "".join(result)
 
 
-async def _wiki_render_all(user_id: int):
-    """Re-render all pages with cross-links."""
-    pages = await _wiki_get_all_pages(user_id)
-    if not pages:
+async def _wiki_render_all(user_id: int, pages: list):
+    """Re-render all pages with cross-links. Needed whenever the set of titles
+    changes (create/delete); body-only updates render just their own page.
+    Only pages whose rendered output actually changed are written."""
+    index = _title_index(pages)
+    changed = []
+    for page in pages:
+        rendered = _render_links(page["content"], index, page["slug"])
+        if rendered != page.get("content_rendered"):
+            changed.append((page, rendered))
+    if not changed:
         return
 
-    for page in pages:
-        rendered = _render_links(page["content"], pages, page["slug"])
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                await client.patch(
-                    f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                    headers={
-                        "apikey": DATABASE_KEY,
-                        "Authorization": f"Bearer {DATABASE_KEY}",
-                        "Content-Type": "application/json",
-                        "Prefer": "return=minimal",
-                    },
-                    params={"id": f"eq.{page['id']}"},
-                    json={"content_rendered": rendered, "updated_at": datetime.now(timezone.utc).isoformat()},
-                )
-        except Exception as e:
-            print(f"⚠️ Wiki render error for {page['title']}: {e}")
+    # One update-only RPC for every changed page instead of a PATCH per page
+    # (see render_wiki_pages in SETUP.md). Only the rendered text is sent.
+    rows = [{"id": page["id"], "content_rendered": rendered} for page, rendered in changed]
+    try:
+        resp = await _supabase.post(
+            "/rpc/render_wiki_pages",
+            headers=SUPABASE_WRITE_HEADERS,
+            content=orjson.dumps({"uid": user_id, "pages": rows}),
+            extensions={"idempotent": True},
+        )
+        if resp.status_code not in (200, 204):
+            logger.warning("Wiki render failed: %s %s", resp.status_code, resp.text)
+            return
+        for page, rendered in changed:
+            page["content_rendered"] = rendered
+    except Exception as e:
+        logger.warning("Wiki render error: %s", e)
 
 
-async def _wiki_create(user_id: int, title: str, content: str) -> bool:
-    """Create a new wiki page."""
-    slug = _slugify(title)
+async def _wiki_create(user_id: int, title: str, content: str, pages: list, slug: str | None = None) -> bool:
+    """Create a new wiki page and add it to `pages`. Pass `slug` if already known."""
+    slug = slug or _slugify(title)
     row = {
         "user_id": user_id,
         "title": title,
@@ -1204,98 +1550,90 @@ async def _wiki_create(user_id: int, title: str, content: str) -> bool:
         "updated_at": datetime.now(timezone.utc).isoformat(),
     }
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(
-                f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=minimal",
-                },
-                json=row,
-            )
+        resp = await _supabase.post(
+            f"/{WIKI_TABLE}",
+            headers={**SUPABASE_WRITE_HEADERS, "Prefer": "return=representation"},
+            params={"select": "id,title,slug,content,content_rendered"},
+            json=row,
+        )
         if resp.status_code in (200, 201):
-            await _wiki_render_all(user_id)
+            pages.extend(orjson.loads(resp.content))
+            await _wiki_render_all(user_id, pages)
             return True
-        print(f"⚠️ Wiki create failed: {resp.status_code} {resp.text}")
+        logger.warning("Wiki create failed: %s %s", resp.status_code, resp.text)
         return False
     except Exception as e:
-        print(f"❌ Wiki create error: {e}")
+        logger.error("Wiki create error: %s", e)
         return False
 
 
-async def _wiki_update(user_id: int, title: str, content: str, append: bool = False) -> bool:
-    """Update an existing wiki page."""
-    slug = _slugify(title)
-    page = await _wiki_get_page(user_id, slug)
-    if not page:
-        return False
+async def _wiki_update(user_id: int, page: dict, content: str, append: bool, pages: list) -> bool:
+    """Update an existing wiki page (an entry of `pages`).
 
+    Only the body changes, so no other page's links can be affected: the page
+    is rendered on its own and saved in the same PATCH, with no full re-render.
+    """
     new_content = page["content"] + "\n\n" + content if append else content
+    rendered = _render_links(new_content, _title_index(pages), page["slug"])
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.patch(
-                f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                    "Content-Type": "application/json",
-                    "Prefer": "return=minimal",
-                },
-                params={"id": f"eq.{page['id']}"},
-                json={
-                    "content": new_content,
-                    "updated_at": datetime.now(timezone.utc).isoformat(),
-                },
-            )
+        resp = await _supabase.patch(
+            f"/{WIKI_TABLE}",
+            headers=SUPABASE_WRITE_HEADERS,
+            params={"id": f"eq.{page['id']}"},
+            json={
+                "content": new_content,
+                "content_rendered": rendered,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            },
+            extensions={"idempotent": True},
+        )
         if resp.status_code in (200, 204):
-            await _wiki_render_all(user_id)
+            page["content"] = new_content
+            page["content_rendered"] = rendered
             return True
         return False
     except Exception as e:
-        print(f"❌ Wiki update error: {e}")
+        logger.error("Wiki update error: %s", e)
         return False
 
 
-async def _wiki_delete(user_id: int, title: str) -> bool:
-    """Delete a wiki page."""
-    slug = _slugify(title)
+async def _wiki_delete(user_id: int, page: dict, pages: list) -> bool:
+    """Delete a wiki page (an entry of `pages`)."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.delete(
-                f"{DATABASE_URL}/rest/v1/{WIKI_TABLE}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={"user_id": f"eq.{user_id}", "slug": f"eq.{slug}"},
-            )
+        resp = await _supabase.delete(
+            f"/{WIKI_TABLE}",
+            params={"id": f"eq.{page['id']}"},
+        )
         if resp.status_code in (200, 204):
-            await _wiki_render_all(user_id)
+            pages.remove(page)
+            await _wiki_render_all(user_id, pages)
             return True
         return False
     except Exception as e:
-        print(f"❌ Wiki delete error: {e}")
+        logger.error("Wiki delete error: %s", e)
         return False
 
 
-async def _ensure_main_page(user_id: int):
+async def _ensure_main_page(user_id: int, pages: list):
     """Create the Main page if it doesn't exist."""
-    page = await _wiki_get_page(user_id, "main")
-    if not page:
-        await _wiki_create(user_id, "Main", "# Welcome to your Personal Wiki\n\nThis is your starting page. Edit it via Telegram!")
+    if not _find_page(pages, "main"):
+        await _wiki_create(user_id, "Main", "# Welcome to your Personal Wiki\n\nThis is your starting page. Edit it via Telegram!", pages)
 
 
-async def handle_wiki(update: Update, user_message: str, user_id: int):
+async def handle_wiki(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str, user_id: int):
     """Handle wiki-related messages."""
-    await update.message.chat.send_action("typing")
+    context.application.create_task(update.message.chat.send_action("typing"))
 
-    # Ensure Main page exists
-    await _ensure_main_page(user_id)
+    # The page list is fetched once (alongside the parse) and shared by every
+    # step below, which keeps it current as pages are added or removed.
+    pages, parsed = await asyncio.gather(_wiki_get_all_pages(user_id), _wiki_parse(user_message))
+    if pages is None:
+        await update.message.reply_text("❌ Couldn't load your wiki. Please try again.")
+        return
 
-    parsed = await _wiki_parse(user_message)
+    # Ensure Main page exists
+    await _ensure_main_page(user_id, pages)
 
     if parsed.get("needs_clarification"):
         question = parsed.get("clarification_question", "Could you clarify your wiki command?")
@@ -1306,21 +1644,22 @@ async def handle_wiki(update: Update, user_message: str, user_id: int):
     title = parsed.get("title", "")
     content = parsed.get("content", "")
     append = parsed.get("append", False)
+    slug = _slugify(title)
 
     if op == "create":
         # Check if page already exists
-        existing = await _wiki_get_page(user_id, _slugify(title))
-        if existing:
+        if _find_page(pages, slug):
             await update.message.reply_text(f"⚠️ Page *{title}* already exists. Use 'wiki update' to edit it.", parse_mode="Markdown")
             return
-        success = await _wiki_create(user_id, title, content)
+        success = await _wiki_create(user_id, title, content, pages, slug)
         if success:
             await update.message.reply_text(f"📝 Created wiki page: *{title}*", parse_mode="Markdown")
         else:
             await update.message.reply_text("❌ Failed to create wiki page.")
 
     elif op == "update":
-        success = await _wiki_update(user_id, title, content, append)
+        page = _find_page(pages, slug)
+        success = page is not None and await _wiki_update(user_id, page, content, append, pages)
         if success:
             action_word = "Updated" if not append else "Appended to"
             await update.message.reply_text(f"📝 {action_word} wiki page: *{title}*", parse_mode="Markdown")
@@ -1328,10 +1667,11 @@ async def handle_wiki(update: Update, user_message: str, user_id: int):
             await update.message.reply_text(f"❌ Page *{title}* not found.", parse_mode="Markdown")
 
     elif op == "delete":
-        if _slugify(title) == "main":
+        if slug == "main":
             await update.message.reply_text("⚠️ Can't delete the Main page!")
             return
-        success = await _wiki_delete(user_id, title)
+        page = _find_page(pages, slug)
+        success = page is not None and await _wiki_delete(user_id, page, pages)
         if success:
             await update.message.reply_text(f"🗑️ Deleted wiki page: *{title}*", parse_mode="Markdown")
         else:
@@ -1344,101 +1684,173 @@ async def handle_wiki(update: Update, user_message: str, user_id: int):
 # ---------------------------------------------------------------------------
 # Reminder scheduler
 # ---------------------------------------------------------------------------
-async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Called every 60 seconds by the job queue. Sends due reminders."""
-    now_utc = datetime.now(timezone.utc)
+# Caps concurrent reminder sends to stay under Telegram's ~30 messages/second.
+_reminder_slots = asyncio.Semaphore(25)
+
+
+async def _send_reminder(bot: Bot, row: dict, data: dict) -> int | None:
+    """Send one reminder. Returns the row id if it was delivered."""
+    user_id = row["user_id"]
+    task = data.get("task", "Something")
+    due = data.get("due", "")
+
+    reminder_text = (
+        f"🔔 *Reminder!*\n\n"
+        f"{task}"
+    )
+    if due:
+        reminder_text += f"\n📅 Due: {due}"
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Fetch all pending todos that have a reminder_time
-            resp = await client.get(
-                f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                headers={
-                    "apikey": DATABASE_KEY,
-                    "Authorization": f"Bearer {DATABASE_KEY}",
-                },
-                params={
-                    "category": "eq.todos",
-                    "select": "id,user_id,data",
-                },
+        async with _reminder_slots:
+            await bot.send_message(
+                chat_id=int(user_id),
+                text=reminder_text,
+                parse_mode="Markdown",
             )
+        logger.info("Sent reminder to %s: %s", user_id, task)
+        return row["id"]
+    except Exception as e:
+        logger.error("Failed to send reminder to %s: %s", user_id, e)
+        return None
 
-        if resp.status_code != 200:
-            print(f"⚠️ Reminder check failed: {resp.status_code}")
+
+# A timed check and the regular poll must not both send the same reminder.
+_reminder_lock = asyncio.Lock()
+_REMINDER_WAKEUP = "reminder-wakeup"
+
+
+def _arm_reminder_wakeup(job_queue, when: datetime):
+    """Make sure a reminder check runs at `when`.
+
+    Only the earliest wake-up is kept: the check it triggers arms the next one.
+    """
+    for job in job_queue.get_jobs_by_name(_REMINDER_WAKEUP):
+        if job.next_t is not None and job.next_t <= when:
             return
+        job.schedule_removal()
+    job_queue.run_once(check_reminders, when, name=_REMINDER_WAKEUP)
 
-        rows = resp.json()
-        for row in rows:
-            data = row["data"] if isinstance(row["data"], dict) else json.loads(row["data"])
-
-            # Skip if no reminder, already reminded, or already done
-            reminder_str = data.get("reminder_time")
-            if not reminder_str:
-                continue
-            if data.get("reminded"):
-                continue
-            if data.get("status") == "done":
-                continue
-
-            # Parse reminder time and check if it's due
-            try:
-                reminder_time = datetime.fromisoformat(reminder_str).astimezone(timezone.utc)
-            except (ValueError, TypeError):
-                continue
 
-            if reminder_time > now_utc:
-                continue
+def _schedule_reminder_check(context: ContextTypes.DEFAULT_TYPE, reminder_time: str):
+    """Run a reminder check right at `reminder_time` rather than up to a poll later.
 
-            # It's due — send the reminder
-            user_id = row["user_id"]
-            task = data.get("task", "Something")
-            due = data.get("due", "")
+    The poll stays: it covers reminders written by the sidecar and wake-ups
+    lost on restart.
+    """
+    try:
+        when = datetime.fromisoformat(reminder_time)
+    except (ValueError, TypeError):
+        return
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=LOCAL_TZ)
+    if when > datetime.now(timezone.utc):
+        _arm_reminder_wakeup(context.job_queue, when)
 
-            reminder_text = (
-                f"🔔 *Reminder!*\n\n"
-                f"{task}"
-            )
-            if due:
-                reminder_text += f"\n📅 Due: {due}"
 
-            try:
-                await context.bot.send_message(
-                    chat_id=int(user_id),
-                    text=reminder_text,
-                    parse_mode="Markdown",
-                )
-                print(f"✅ Sent reminder to {user_id}: {task}")
-            except Exception as e:
-                print(f"❌ Failed to send reminder to {user_id}: {e}")
-                continue
+async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Sends due reminders. Runs every REMINDER_POLL_INTERVAL seconds and at
+    the reminder times it finds coming up."""
+    async with _reminder_lock:
+        await _check_reminders(context)
 
-            # Mark as reminded so we don't send again
-            data["reminded"] = True
+
+async def _check_reminders(context: ContextTypes.DEFAULT_TYPE):
+    now_utc = datetime.now(timezone.utc)
+    horizon = now_utc + timedelta(seconds=REMINDER_POLL_INTERVAL)
+
+    try:
+        # Rows due now or before the next poll: reminder_time, reminded and
+        # status are real columns kept in sync with data by a trigger (see
+        # SETUP.md), so this is a range scan on an indexed column.
+        resp = await _supabase.get(
+            f"/{TABLE_NAME}",
+            params={
+                "category": "eq.todos",
+                "reminded": "is.false",
+                "reminder_time": f"lte.{horizon.isoformat()}",
+                "or": "(status.is.null,status.neq.done)",
+                "select": "id,user_id,data,reminder_time",
+                "order": "reminder_time.asc",
+            },
+        )
+
+        if resp.status_code != 200:
+            logger.warning("Reminder check failed: %s", resp.status_code)
+            return
+
+        due_rows = []
+        for row in orjson.loads(resp.content):
+            when = datetime.fromisoformat(row["reminder_time"])
+            if when > now_utc:
+                # Rows are ordered, so this is the next reminder to come up.
+                _arm_reminder_wakeup(context.job_queue, when)
+                break
+            due_rows.append(row)
+        if not due_rows:
+            return
+
+        # Send all due reminders concurrently, then mark the delivered ones in
+        # a single RPC instead of one PATCH per row.
+        sent = await asyncio.gather(*(_send_reminder(context.bot, row, row["data"]) for row in due_rows))
+        sent_ids = [row_id for row_id in sent if row_id is not None]
+        if sent_ids:
             try:
-                async with httpx.AsyncClient(timeout=10.0) as client:
-                    await client.patch(
-                        f"{DATABASE_URL}/rest/v1/{TABLE_NAME}",
-                        headers={
-                            "apikey": DATABASE_KEY,
-                            "Authorization": f"Bearer {DATABASE_KEY}",
-                            "Content-Type": "application/json",
-                            "Prefer": "return=minimal",
-                        },
-                        params={"id": f"eq.{row['id']}"},
-                        json={"data": data},
-                    )
+                mark_resp = await _supabase.post(
+                    "/rpc/mark_reminded",
+                    headers=SUPABASE_WRITE_HEADERS,
+                    json={"ids": sent_ids},
+                    extensions={"idempotent": True},
+                )
+                if mark_resp.status_code not in (200, 204):
+                    logger.warning("Failed to mark reminded: %s %s", mark_resp.status_code, mark_resp.text)
             except Exception as e:
-                print(f"⚠️ Failed to mark reminded: {e}")
+                logger.warning("Failed to mark reminded: %s", e)
 
     except Exception as e:
-        print(f"❌ Reminder check error: {e}")
+        logger.error("Reminder check error: %s", e)
 
 
 # ---------------------------------------------------------------------------
 # Entry point
 # ---------------------------------------------------------------------------
+async def _post_init(app: Application):
+    global _flusher_task
+    _flusher_task = asyncio.create_task(_write_flusher())
+
+
+async def _post_shutdown(app: Application):
+    """Flush queued writes, then release the shared HTTP pools."""
+    if _flusher_task:
+        _write_queue.put_nowait(None)
+        await _flusher_task
+    await _anthropic.aclose()
+    await _supabase.aclose()
+
+
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        level=logging.INFO,
+    )
+    # httpx logs every request at INFO, which would drown out the bot's own lines.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # libuv-backed event loop for faster socket I/O; not available on Windows.
+    try:
+        import uvloop
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    except ImportError:
+        pass
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
@@ -1448,11 +1860,11 @@ def main():
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    # Schedule reminder checker every 60 seconds
-    app.job_queue.run_repeating(check_reminders, interval=60, first=10)
+    # Poll for reminders; each poll arms exact wake-ups for what's coming up
+    app.job_queue.run_repeating(check_reminders, interval=REMINDER_POLL_INTERVAL, first=10)
 
-    print("🤖 Dashboard bot is running...")
-    print("⏰ Reminder checker active (every 60s)")
+    logger.info("Dashboard bot is running...")
+    logger.info("Reminder checker active (every %ds)", REMINDER_POLL_INTERVAL)
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 